@@ -4,21 +4,200 @@ Code Diff Analyzer Tool
 Analyzes Java code changes between git branches and packs them using infiniloom.
 """
 
+import atexit
 import os
 import sys
 import subprocess
+import tarfile
+import tempfile
 import argparse
+import functools
+import hashlib
 import json
+import logging
 import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
 from dotenv import load_dotenv
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+_DOTENV_LOADED = False
+
+# Added to the environment of git subprocesses: the C locale skips git's
+# locale setup and keeps messages stable, and disabling optional locks stops
+# read-only commands from opportunistically rewriting the index
+GIT_ENV_OVERRIDES = {'LC_ALL': 'C', 'GIT_OPTIONAL_LOCKS': '0'}
+
+# Dependency lists at or below this size are read straight from git instead
+# of spawning infiniloom
+FAST_PATH_THRESHOLD = 3
+
+# Timeouts for the Claude CLI calls, in seconds
+DEPENDENCY_ANALYSIS_TIMEOUT = 180
+CODE_REVIEW_TIMEOUT = 300
+
+# Diffs longer than this many characters (roughly 8k tokens) are split per
+# file into batches of about this size and analyzed in parallel
+DEPENDENCY_BATCH_CHARS = 32000
+DEPENDENCY_ANALYSIS_WORKERS = 4
+
+# Cached Claude responses older than this are ignored, in seconds
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+
+# Static instructions are sent as the system prompt so they form a stable
+# prefix that Claude can serve from its prompt cache across runs; only the
+# diff and packed context vary between requests.
+DEPENDENCY_ANALYSIS_INSTRUCTIONS = """You are a code review assistant specialized in identifying relevant dependencies and context for understanding code changes across multiple programming languages and frameworks.
+
+## Task
+Analyze the provided git diff output and identify dependencies that should be included as additional context for code review.
+
+## Analysis Focus
+
+### Include:
+1. **Direct Dependencies**: Classes, modules, functions, or types that are:
+   - Directly imported/used in the changed code
+   - Modified or extended by the changes
+   - Called or instantiated in the diff
+
+2. **Contextual Dependencies**: Related components that aid understanding:
+   - Service/repository/utility classes or modules
+   - Domain models, entities, or data structures referenced
+   - Interface definitions or abstract base classes
+   - Configuration classes or modules
+   - Custom types or type definitions
+
+### Exclude:
+1. **Standard Library Components**:
+   - Java: `java.*`, `javax.*`
+   - .NET: `System.*`, `Microsoft.*`
+   - Python: `builtins`, standard library modules (e.g., `os`, `sys`, `json`)
+   - Rust: `std::*`
+   - JavaScript/TypeScript: built-in objects, Node.js core modules
+
+2. **Common Framework Components**:
+   - Java: `org.springframework.*`, `org.hibernate.*`
+   - .NET: `Microsoft.AspNetCore.*`, `Microsoft.EntityFrameworkCore.*`
+   - Python: `django.*`, `flask.*`, `sqlalchemy.*`
+   - Rust: `tokio::*`, `serde::*`, `actix_web::*`
+   - JavaScript/TypeScript: `react`, `express`, `@angular/*`
+
+## Path Format Guidelines
+- Java: `com/example/package/ClassName`
+- .NET: `Namespace.SubNamespace.ClassName`
+- Python: `package.module.ClassName` or `package/module.py`
+- Rust: `crate::module::Type` or `src/module/file.rs`
+- JavaScript/TypeScript: `src/package/module.ts` or `@scope/package/module`
+
+## Output Format
+Return ONLY a valid JSON object with no markdown formatting, explanations, or additional text:
+{
+    "classes": [
+        "dependency/path/1",
+        "dependency/path/2"
+    ]
+}
+
+## Validation Rules
+- Array must contain at least 0 elements (empty array is valid if no relevant dependencies)
+- Each path must be a string
+- Paths should use the appropriate format for the detected language
+- No duplicate entries
+- No standard library or common framework paths
+
+## Self-Verification
+Before returning:
+1. ✓ Are all included dependencies actually referenced in the diff?
+2. ✓ Are standard library and common framework components excluded?
+3. ✓ Are project-specific exclusion paths respected?
+4. ✓ Is the output valid JSON without markdown formatting?
+5. ✓ Are paths in the correct format for the detected language?
+"""
+
+CODE_REVIEW_INSTRUCTIONS = """Given the Git Diff and Reference as additional context, please help review Git Diff and provide suggestions if needed.
+
+Please provide a comprehensive code review focusing on:
+- Code quality and best practices
+- Potential bugs or issues
+- Performance considerations
+- Security concerns
+- Potential Business logic impact
+- Suggestions for improvements
+"""
+
+# Matches the key of the "classes" array in Claude's dependency answer
+_CLASSES_KEY_RE = re.compile(r'"classes"\s*:\s*')
+
+_JSON_DECODER = json.JSONDecoder()
 
+# Matches the Claude CLI's complaint when it predates streamed JSON output
+_STREAMING_UNSUPPORTED_RE = re.compile(r'unknown option|include-partial-messages|stream-json')
+
+# Zero-width match at the start of each file section of a git diff
+_DIFF_FILE_START_RE = re.compile(r'^(?=diff --git )', re.M)
+
+# Serializes remote fetches when both branches are resolved concurrently
+_FETCH_LOCK = threading.Lock()
+
+# libgit2 repository handles must not be used from several threads at once
+_PYGIT2_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ReviewResult:
+    """Paths and results produced by a single review run."""
+    # Declared by hand rather than with slots=True to keep Python 3.9 support
+    __slots__ = ('diff_file', 'classes', 'output_file', 'prompt_file', 'review_file', 'review')
+
+    diff_file: str
+    classes: List[str]
+    output_file: Optional[str]
+    prompt_file: str
+    review_file: Optional[str]
+    review: str
+
+
+def _ensure_dotenv() -> None:
+    """Load the .env file once per process."""
+    global _DOTENV_LOADED
+    if not _DOTENV_LOADED:
+        load_dotenv()
+        _DOTENV_LOADED = True
+
+
+def _git_env() -> Dict[str, str]:
+    """Build the environment for a git subprocess from the current environment.
+
+    It is built per call so variables from .env (e.g. GIT_SSH_COMMAND or
+    proxy settings) and later changes by the caller reach git.
+    """
+    _ensure_dotenv()
+    return {**os.environ, **GIT_ENV_OVERRIDES}
+
+
+@functools.lru_cache(maxsize=1)
 def get_repo_path() -> str:
-    """Get repository path from environment variable or .env file."""
+    """Get repository path from environment variable or .env file.
+
+    The result is cached for the life of the process; failures are not cached.
+    """
     # Load .env file if it exists
-    load_dotenv()
+    _ensure_dotenv()
 
     repo_path = os.getenv('REPO_PATH')
     if not repo_path:
@@ -30,35 +209,195 @@ def get_repo_path() -> str:
     return repo_path
 
 
-def git_ref_exists(repo_path: str, ref: str) -> bool:
-    """Check if a git reference (branch, tag, commit) exists."""
-    try:
-        result = subprocess.run(
-            ['git', 'rev-parse', '--verify', ref],
+class GitCatFileBatch:
+    """A long-running `git cat-file --batch-check` or `--batch` process.
+
+    Each query is one line written to the child's stdin, so repeated lookups
+    pay git's process start-up and repository discovery cost only once.
+    With `with_contents` the process also returns object contents (`--batch`).
+    """
+
+    def __init__(self, repo_path: str, with_contents: bool = False):
+        self.repo_path = repo_path
+        self.with_contents = with_contents
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            ['git', 'cat-file', '--batch' if with_contents else '--batch-check'],
             cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=False
+            env=_git_env(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
         )
-        return result.returncode == 0
-    except Exception:
-        return False
+
+    def _query(self, ref: str) -> Tuple[Optional[bytes], Optional[bytes]]:
+        """Send one query and return its header line and, in --batch mode, the object contents."""
+        with self._lock:
+            self._process.stdin.write(f'{ref}\n'.encode('utf-8'))
+            self._process.stdin.flush()
+            line = self._process.stdout.readline()
+            if not line:
+                raise RuntimeError("git cat-file exited unexpectedly")
+
+            # "<sha> <type> <size>" when found, "<ref> missing" or "<ref> ambiguous" otherwise
+            line = line.rstrip(b'\n')
+            if line.endswith((b' missing', b' ambiguous')):
+                return None, None
+
+            contents = None
+            if self.with_contents:
+                # The contents are followed by a single newline
+                size = int(line.rsplit(b' ', 1)[1])
+                contents = self._process.stdout.read(size + 1)[:size]
+            return line, contents
+
+    def resolve(self, ref: str) -> Optional[str]:
+        """Return the object id a git reference resolves to, or None if it does not exist."""
+        header, _ = self._query(ref)
+        if header is None:
+            return None
+        return header.split(b' ', 1)[0].decode('ascii')
+
+    def exists(self, ref: str) -> bool:
+        """Check if a git reference (branch, tag, commit) resolves to an object."""
+        return self.resolve(ref) is not None
+
+    def read(self, ref: str) -> Optional[bytes]:
+        """Return the contents of an object such as `<branch>:<path>`, or None if it does not exist."""
+        if not self.with_contents:
+            raise ValueError("read() requires a cat-file process started with with_contents=True")
+        _, contents = self._query(ref)
+        return contents
+
+    def close(self) -> None:
+        """Terminate the child process."""
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        self._process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_CAT_FILE_BATCHES: Dict[Tuple[str, bool], GitCatFileBatch] = {}
+_CAT_FILE_BATCHES_LOCK = threading.Lock()
+
+
+def get_cat_file_batch(repo_path: str, with_contents: bool = False) -> GitCatFileBatch:
+    """Get the shared cat-file batch process for a repository, starting it if needed."""
+    with _CAT_FILE_BATCHES_LOCK:
+        batch = _CAT_FILE_BATCHES.get((repo_path, with_contents))
+        if batch is None:
+            batch = GitCatFileBatch(repo_path, with_contents)
+            _CAT_FILE_BATCHES[(repo_path, with_contents)] = batch
+        return batch
+
+
+@atexit.register
+def close_cat_file_batches() -> None:
+    """Terminate all shared cat-file batch processes."""
+    with _CAT_FILE_BATCHES_LOCK:
+        for batch in _CAT_FILE_BATCHES.values():
+            batch.close()
+        _CAT_FILE_BATCHES.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def open_pygit2_repo(repo_path: str):
+    """Open the repository with pygit2, or return None if pygit2 is unavailable."""
+    if pygit2 is None:
+        return None
+    try:
+        return pygit2.Repository(repo_path)
+    except pygit2.GitError:
+        return None
+
+
+def resolve_first_existing_ref(repo_path: str, refs: List[str]) -> Optional[str]:
+    """Return the first of the given refs that resolves to an object, or None.
+
+    Candidates are checked against a shared `git cat-file --batch-check`
+    process instead of spawning one `git rev-parse --verify` per ref. When
+    pygit2 is installed the refs are resolved in-process without spawning git.
+    """
+    repo = open_pygit2_repo(repo_path)
+    if repo is not None:
+        with _PYGIT2_LOCK:
+            for ref in refs:
+                try:
+                    repo.revparse_single(ref)
+                    return ref
+                except (KeyError, ValueError, pygit2.GitError):
+                    continue
+        return None
+
+    try:
+        batch = get_cat_file_batch(repo_path)
+        for ref in refs:
+            if batch.exists(ref):
+                return ref
+    except (RuntimeError, OSError):
+        pass
+    return None
+
+
+def resolve_commit_sha(repo_path: str, ref: str) -> Optional[str]:
+    """Resolve a git reference to the SHA of the commit it points to, or None."""
+    repo = open_pygit2_repo(repo_path)
+    if repo is not None:
+        with _PYGIT2_LOCK:
+            try:
+                return str(repo.revparse_single(ref).peel(pygit2.Commit).id)
+            except (KeyError, ValueError, pygit2.GitError):
+                return None
+
+    try:
+        return get_cat_file_batch(repo_path).resolve(f'{ref}^{{commit}}')
+    except (RuntimeError, OSError):
+        return None
 
 
 def fetch_all_branches(repo_path: str) -> None:
     """Fetch all branches from remote repositories."""
     try:
         print("Fetching all branches from remote...")
-        result = subprocess.run(
-            ['git', 'fetch', '--all'],
+        subprocess.run(
+            ['git', 'fetch', '--all', '--quiet'],
             cwd=repo_path,
-            capture_output=True,
-            text=True,
+            env=_git_env(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             check=True
         )
         print("Successfully fetched all branches")
     except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to fetch branches: {e.stderr}")
+        raise RuntimeError(f"Failed to fetch branches: {e.stderr.decode('utf-8', 'replace')}")
+
+
+def fetch_single_branch(repo_path: str, branch: str) -> bool:
+    """Fetch a single branch from origin into refs/remotes/origin/<branch>.
+
+    Returns False if the fetch failed (e.g. the branch is not on origin).
+    """
+    print(f"Fetching branch '{branch}' from origin...")
+    result = subprocess.run(
+        ['git', 'fetch', '--no-tags', '--quiet', 'origin', f'{branch}:refs/remotes/origin/{branch}'],
+        cwd=repo_path,
+        env=_git_env(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False
+    )
+    if result.returncode != 0:
+        print(f"⚠ Targeted fetch failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+        return False
+
+    print(f"Successfully fetched {branch}")
+    return True
 
 
 def ensure_branch_exists(repo_path: str, branch: str) -> str:
@@ -71,19 +410,25 @@ def ensure_branch_exists(repo_path: str, branch: str) -> str:
         f'refs/remotes/origin/{branch}'  # full remote ref
     ]
 
-    # Check if any ref exists
-    for ref in possible_refs:
-        if git_ref_exists(repo_path, ref):
-            print(f"Found ref: {ref}")
+    ref = resolve_first_existing_ref(repo_path, possible_refs)
+    if ref:
+        print(f"Found ref: {ref}")
+        return ref
+
+    with _FETCH_LOCK:
+        # Another thread may have fetched while we were waiting for the lock
+        ref = resolve_first_existing_ref(repo_path, possible_refs)
+        if ref:
+            print(f"Found ref after fetch: {ref}")
             return ref
 
-    # If not found, try fetching
-    print(f"Branch '{branch}' not found locally, fetching from remote...")
-    fetch_all_branches(repo_path)
+        # If not found, try fetching
+        print(f"Branch '{branch}' not found locally, fetching from remote...")
+        fetch_single_branch(repo_path, branch)
 
-    # Try again after fetch
-    for ref in possible_refs:
-        if git_ref_exists(repo_path, ref):
+        # Try again after fetch
+        ref = resolve_first_existing_ref(repo_path, possible_refs)
+        if ref:
             print(f"Found ref after fetch: {ref}")
             return ref
 
@@ -91,48 +436,106 @@ def ensure_branch_exists(repo_path: str, branch: str) -> str:
     raise ValueError(f"Branch '{branch}' not found even after fetching. Please check the branch name.")
 
 
-def get_current_branch(repo_path: str) -> str:
-    """Get the currently checked out branch."""
-    try:
-        result = subprocess.run(
-            ['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+def extract_files_from_git(repo_path: str, branch_ref: str, file_paths: List[str], target_dir: str) -> None:
+    """Extract the given files from a git branch into target_dir without checking it out."""
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(
+            ['git', '--literal-pathspecs', 'archive', '--format=tar', branch_ref, '--', *file_paths],
             cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=True
+            env=_git_env(),
+            stdout=subprocess.PIPE,
+            stderr=stderr_file
         )
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to get current branch: {e.stderr}")
+        tar_error = None
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(target_dir, filter='data')
+                else:
+                    tar.extractall(target_dir)
+        except tarfile.TarError as e:
+            tar_error = e
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise RuntimeError(f"Failed to archive files from {branch_ref}: "
+                               f"{stderr_file.read().decode('utf-8', 'replace')}")
+        if tar_error is not None:
+            raise RuntimeError(f"Failed to extract files from {branch_ref}: {tar_error}")
+
+
+def execute_infiniloom_pack_from_git(repo_path: str, branch_ref: str, file_paths: List[str], output_file: str) -> str:
+    """Pack files from a git branch with infiniloom without touching the working tree.
+
+    Only the given files are extracted with `git archive` into a temporary
+    directory, which infiniloom then packs.
+    """
+    with tempfile.TemporaryDirectory(prefix='codesentry-') as tmp_dir:
+        extract_files_from_git(repo_path, branch_ref, file_paths, tmp_dir)
+        return execute_infiniloom_pack_with_classes(tmp_dir, file_paths, output_file)
+
 
+@contextmanager
+def destination_worktree(repo_path: str, dest_ref: str) -> Iterator[str]:
+    """Check out dest_ref into a temporary detached worktree and yield its path.
 
-def checkout_branch(repo_path: str, branch_ref: str) -> None:
-    """Checkout a specific branch."""
+    The repository's own HEAD, index and working tree are left untouched; the
+    worktree is removed again on exit.
+    """
+    remove_failed = False
     try:
-        print(f"Checking out branch: {branch_ref}")
-        result = subprocess.run(
-            ['git', 'checkout', branch_ref],
-            cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        print(f"✓ Successfully checked out {branch_ref}")
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to checkout branch: {e.stderr}")
+        with tempfile.TemporaryDirectory(prefix='codesentry-') as tmp_dir:
+            worktree_dir = os.path.join(tmp_dir, 'worktree')
+            print(f"Checking out {dest_ref} into a temporary worktree")
+            try:
+                subprocess.run(
+                    ['git', 'worktree', 'add', '--detach', '--quiet', worktree_dir, dest_ref],
+                    cwd=repo_path,
+                    env=_git_env(),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    check=True
+                )
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError(f"Failed to create worktree for {dest_ref}: {e.stderr.decode('utf-8', 'replace')}")
+            try:
+                yield worktree_dir
+            finally:
+                result = subprocess.run(
+                    ['git', 'worktree', 'remove', '--force', worktree_dir],
+                    cwd=repo_path,
+                    env=_git_env(),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    check=False
+                )
+                if result.returncode != 0:
+                    remove_failed = True
+                    print(f"⚠ Could not remove temporary worktree: {result.stderr.decode('utf-8', 'replace').strip()}")
+    finally:
+        # The directory is gone once TemporaryDirectory has cleaned up, so
+        # prune drops the worktree's stale administrative entry
+        if remove_failed:
+            result = subprocess.run(
+                ['git', 'worktree', 'prune'],
+                cwd=repo_path,
+                env=_git_env(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=False
+            )
+            if result.returncode != 0:
+                print(f"⚠ Could not prune stale worktrees: {result.stderr.decode('utf-8', 'replace').strip()}")
 
 
-def execute_infiniloom_pack_with_classes(repo_path: str, class_list: List[str], output_dir: str) -> str:
+def execute_infiniloom_pack_with_classes(repo_path: str, class_list: List[str], output_file: str) -> str:
     """Execute infiniloom pack command with the list of classes."""
     if not class_list:
         raise ValueError("No classes to pack")
 
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Build the output path
-    output_file = os.path.join(output_dir, 'llm.txt')
-
     # Build the command
     cmd = ['infiniloom', 'pack', '.', '--compression', 'balanced', '--format', 'toon',
            '--remove-comments', '--remove-empty-lines', '--no-symbols', '--max-tokens', '16000', '--output',
@@ -164,157 +567,610 @@ def execute_infiniloom_pack_with_classes(repo_path: str, class_list: List[str],
         raise RuntimeError("infiniloom command not found. Please ensure it's installed and in PATH")
 
 
+def list_tree_files(repo_path: str, branch_ref: str) -> List[str]:
+    """List all file paths in the tree of a git branch."""
+    try:
+        result = subprocess.run(
+            ['git', 'ls-tree', '-r', '-z', '--name-only', branch_ref],
+            cwd=repo_path,
+            env=_git_env(),
+            capture_output=True,
+            check=True
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to list files of {branch_ref}: {e.stderr.decode('utf-8', 'replace')}")
+
+    return [path.decode('utf-8', 'surrogateescape') for path in result.stdout.split(b'\0') if path]
+
+
+def resolve_class_files(tree_files: List[str], class_list: List[str]) -> Optional[List[str]]:
+    """Map each class path suggested by the LLM to exactly one file in the tree.
+
+    A class such as `com/example/Foo` matches a file whose path, with or
+    without its extension, ends with it (e.g. `src/main/java/com/example/Foo.java`).
+    If a class without an extension matches several files, such as a MyBatis
+    `FooMapper.java` next to `FooMapper.xml`, the single `.java` file wins.
+    Returns None if any class matches no file or more than one file. Classes
+    that resolve to the same file (e.g. `Foo` and `com/example/Foo`) yield it
+    once.
+    """
+    files_by_stem: Dict[str, List[str]] = {}
+    for path in tree_files:
+        stem = os.path.splitext(path.rsplit('/', 1)[-1])[0]
+        files_by_stem.setdefault(stem, []).append(path)
+
+    resolved = []
+    for class_path in class_list:
+        class_path = class_path.strip().removeprefix('./')
+        name = class_path.rsplit('/', 1)[-1]
+        candidates = files_by_stem.get(name, []) + files_by_stem.get(os.path.splitext(name)[0], [])
+        matches = {
+            path for path in candidates
+            if any(p == class_path or p.endswith('/' + class_path)
+                   for p in (path, os.path.splitext(path)[0]))
+        }
+        if len(matches) > 1 and not os.path.splitext(name)[1]:
+            java_matches = {path for path in matches if path.endswith('.java')}
+            if len(java_matches) == 1:
+                matches = java_matches
+        if len(matches) != 1:
+            return None
+        resolved.append(matches.pop())
+
+    return list(dict.fromkeys(resolved))
+
+
+def pack_files_from_git(repo_path: str, branch_ref: str, file_paths: List[str], output_file: str) -> str:
+    """Write the given files from a git branch into llm.txt without running infiniloom."""
+    print(f"\nReading {len(file_paths)} files directly from {branch_ref}...")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for file_path in file_paths:
+            content = read_file_content_from_git(repo_path, branch_ref, file_path)
+            f.write(f"## File: {file_path}\n{content}\n")
+
+    print(f"Output saved to: {output_file}")
+    return output_file
+
+
 def read_file_content_from_git(repo_path: str, branch_ref: str, file_path: str) -> str:
     """Read and return the content of a file from a git branch."""
+    repo = open_pygit2_repo(repo_path)
+    if repo is not None:
+        with _PYGIT2_LOCK:
+            try:
+                return repo.revparse_single(f'{branch_ref}:{file_path}').data.decode('utf-8', 'replace')
+            except (KeyError, ValueError, AttributeError, pygit2.GitError):
+                pass  # fall through so git can explain the failure
+
+    try:
+        content = get_cat_file_batch(repo_path, with_contents=True).read(f'{branch_ref}:{file_path}')
+        if content is not None:
+            return content.decode('utf-8', 'replace')
+    except (RuntimeError, OSError):
+        pass
+
+    # Fall back to `git show`, which also reports why the file could not be read
     try:
         result = subprocess.run(
             ['git', 'show', f'{branch_ref}:{file_path}'],
             cwd=repo_path,
+            env=_git_env(),
             capture_output=True,
-            text=True,
             check=True
         )
-        return result.stdout
+        return result.stdout.decode('utf-8', 'replace')
     except subprocess.CalledProcessError as e:
-        return f"[Error reading file from git: {e.stderr.strip()}]"
+        return f"[Error reading file from git: {e.stderr.decode('utf-8', 'replace').strip()}]"
     except Exception as e:
         return f"[Error: {str(e)}]"
 
 
-def analyze_diff_for_dependencies(diff_content: str) -> List[str]:
-    """Call Claude Code CLI to analyze git diff and suggest dependency classes for context."""
-
-    prompt = f"""
-    You are a code review assistant specialized in identifying relevant dependencies and context for understanding code changes across multiple programming languages and frameworks.
-    
-    ## Task
-    Analyze the provided git diff output and identify dependencies that should be included as additional context for code review.
-    
-    ## Analysis Focus
-    
-    ### Include:
-    1. **Direct Dependencies**: Classes, modules, functions, or types that are:
-       - Directly imported/used in the changed code
-       - Modified or extended by the changes
-       - Called or instantiated in the diff
-    
-    2. **Contextual Dependencies**: Related components that aid understanding:
-       - Service/repository/utility classes or modules
-       - Domain models, entities, or data structures referenced
-       - Interface definitions or abstract base classes
-       - Configuration classes or modules
-       - Custom types or type definitions
-    
-    ### Exclude:
-    1. **Standard Library Components**:
-       - Java: `java.*`, `javax.*`
-       - .NET: `System.*`, `Microsoft.*`
-       - Python: `builtins`, standard library modules (e.g., `os`, `sys`, `json`)
-       - Rust: `std::*`
-       - JavaScript/TypeScript: built-in objects, Node.js core modules
-    
-    2. **Common Framework Components**:
-       - Java: `org.springframework.*`, `org.hibernate.*`
-       - .NET: `Microsoft.AspNetCore.*`, `Microsoft.EntityFrameworkCore.*`
-       - Python: `django.*`, `flask.*`, `sqlalchemy.*`
-       - Rust: `tokio::*`, `serde::*`, `actix_web::*`
-       - JavaScript/TypeScript: `react`, `express`, `@angular/*`
-    
-    ## Path Format Guidelines
-    - Java: `com/example/package/ClassName`
-    - .NET: `Namespace.SubNamespace.ClassName`
-    - Python: `package.module.ClassName` or `package/module.py`
-    - Rust: `crate::module::Type` or `src/module/file.rs`
-    - JavaScript/TypeScript: `src/package/module.ts` or `@scope/package/module`
-    
-    ## Output Format
-    Return ONLY a valid JSON object with no markdown formatting, explanations, or additional text:    
-    "classes": [
-        "dependency/path/1",
-        "dependency/path/2"
-    ]"        
-    
-    ## Validation Rules
-    - Array must contain at least 0 elements (empty array is valid if no relevant dependencies)
-    - Each path must be a string
-    - Paths should use the appropriate format for the detected language
-    - No duplicate entries
-    - No standard library or common framework paths
-    
-    ## Git Diff Input
-    {diff_content}
-
-    ## Self-Verification
-    Before returning:
-    1. ✓ Are all included dependencies actually referenced in the diff?
-    2. ✓ Are standard library and common framework components excluded?
-    3. ✓ Are project-specific exclusion paths respected?
-    4. ✓ Is the output valid JSON without markdown formatting?
-    5. ✓ Are paths in the correct format for the detected language?
+def get_response_cache_dir(cache_dir: str) -> str:
+    """Return the directory holding cached Claude responses.
+
+    It is kept apart from the dependency-context entries, which do not expire,
+    so expired responses can be pruned by file pattern alone.
     """
+    return os.path.join(cache_dir, 'responses')
 
-    print("Calling Claude Code CLI to analyze diff and suggest dependencies...")
 
+def get_response_cache_file(cache_dir: str, kind: str, system_prompt: str, prompt_chunks: Iterable[bytes]) -> str:
+    """Build the cache file path for a Claude response to the exact given prompts."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(system_prompt.encode('utf-8'))
+    digest.update(b'\0')
+    for chunk in prompt_chunks:
+        digest.update(chunk)
+    return os.path.join(get_response_cache_dir(cache_dir), f'{digest.hexdigest()}.{kind}.json')
+
+
+def iter_file_chunks(path: str, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Yield the contents of a file in fixed-size chunks."""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def load_cached_response(cache_file: str):
+    """Return a cached Claude response, or None if missing or older than RESPONSE_CACHE_TTL.
+
+    An expired entry is deleted.
+    """
     try:
-        result = subprocess.run(
-            ["claude", "-p", prompt, "--output-format", "json"],
-            capture_output=True,
-            text=True,
-            check=True,
-            timeout=180000  # 3 minute timeout
+        if time.time() - os.path.getmtime(cache_file) > RESPONSE_CACHE_TTL:
+            with suppress(OSError):
+                os.remove(cache_file)
+            return None
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def prune_response_cache(cache_dir: str) -> None:
+    """Delete cached Claude responses older than RESPONSE_CACHE_TTL."""
+    cutoff = time.time() - RESPONSE_CACHE_TTL
+    try:
+        with os.scandir(get_response_cache_dir(cache_dir)) as entries:
+            expired = [entry.path for entry in entries
+                       if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        print(f"⚠ Could not prune Claude response cache: {e}")
+        return
+
+    for path in expired:
+        with suppress(OSError):
+            os.remove(path)
+
+
+def save_cached_response(cache_file: str, value) -> None:
+    """Store a Claude response for reuse by later runs with the same prompt."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+    except OSError as e:
+        print(f"⚠ Could not cache Claude response: {e}")
+
+
+def run_claude(prompt: str, system_prompt: str, timeout: int) -> Dict:
+    """Run the Claude Code CLI in print mode and return its parsed JSON response.
+
+    The system prompt is appended to Claude's default one, keeping the static
+    instructions ahead of the variable prompt so they can be prompt-cached.
+    The prompt is sent on stdin, so its size is not limited by ARG_MAX.
+    """
+    result = subprocess.run(
+        ["claude", "-p", "--append-system-prompt", system_prompt, "--output-format", "json"],
+        input=prompt,
+        capture_output=True,
+        text=True,
+        check=True,
+        timeout=timeout
+    )
+    response = json.loads(result.stdout)
+    print_prompt_cache_usage(response)
+    return response
+
+
+def stream_claude(prompt_file: str, system_prompt: str, timeout: int, on_text: Callable[[str], None]) -> Dict:
+    """Run the Claude Code CLI on the prompt stored in prompt_file with streamed JSON output.
+
+    The file is passed as Claude's stdin rather than loaded into memory.
+    on_text is called with each piece of assistant text as it arrives. Returns
+    the final "result" event, or an empty dict if the stream ended without one.
+    A CLI too old for streamed output is re-run with plain JSON output, and
+    on_text then receives the whole answer at once.
+    Raises the same exceptions as subprocess.run(..., check=True, timeout=timeout).
+    """
+    cmd = ["claude", "-p", "--append-system-prompt", system_prompt,
+           "--output-format", "stream-json", "--verbose", "--include-partial-messages"]
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        process.kill()
+
+    # stderr goes to a file so a chatty CLI cannot fill the pipe while stdout is read
+    with tempfile.TemporaryFile(mode='w+', encoding='utf-8') as stderr_file, \
+            open(prompt_file, 'rb') as stdin_file:
+        process = subprocess.Popen(cmd, stdin=stdin_file, stdout=subprocess.PIPE, stderr=stderr_file,
+                                   text=True, encoding='utf-8')
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.start()
+        result_event = {}
+        try:
+            for line in process.stdout:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event.get("type") == "stream_event":
+                    delta = event.get("event", {}).get("delta", {})
+                    if delta.get("type") == "text_delta":
+                        on_text(delta["text"])
+                elif event.get("type") == "result":
+                    result_event = event
+            returncode = process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            if result_event or not _STREAMING_UNSUPPORTED_RE.search(stderr):
+                raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+    if returncode != 0:
+        print("⚠ Claude CLI does not support streamed output, waiting for the complete review instead")
+        with open(prompt_file, 'rb') as stdin_file:
+            result = subprocess.run(
+                ["claude", "-p", "--append-system-prompt", system_prompt, "--output-format", "json"],
+                stdin=stdin_file,
+                capture_output=True,
+                text=True,
+                encoding='utf-8',
+                check=True,
+                timeout=timeout
+            )
+        result_event = json.loads(result.stdout)
+        if "result" in result_event:
+            on_text(result_event["result"])
+
+    print_prompt_cache_usage(result_event)
+    return result_event
+
+
+def print_prompt_cache_usage(response: Dict) -> None:
+    """Print how much of the prompt Claude served from its prompt cache."""
+    usage = response.get("usage") or {}
+    if usage:
+        print(f"  Prompt cache: {usage.get('cache_read_input_tokens', 0)} tokens read, "
+              f"{usage.get('cache_creation_input_tokens', 0)} tokens written")
+
+
+def parse_classes_from_response(response_text: str) -> Optional[List[str]]:
+    """Extract the "classes" array from Claude's answer, or None if there is none.
+
+    The array following the "classes" key is decoded with
+    JSONDecoder.raw_decode, which scans forward once and tolerates prose,
+    code fences or a missing outer object around it.
+    """
+    pos = response_text.find('"classes"')
+    while pos != -1:
+        match = _CLASSES_KEY_RE.match(response_text, pos)
+        if match:
+            try:
+                classes, _ = _JSON_DECODER.raw_decode(response_text, match.end())
+                if isinstance(classes, list):
+                    return classes
+            except json.JSONDecodeError:
+                pass
+        pos = response_text.find('"classes"', pos + 1)
+    return None
+
+
+def dedupe_class_paths(class_list: List[str]) -> List[str]:
+    """Drop empty and duplicate class paths, keeping the first spelling of each.
+
+    `com/example/Foo`, `./com/example/Foo` and `com/example/Foo.java` count as
+    the same class.
+    """
+    seen = set()
+    cleaned = []
+    for class_path in class_list:
+        if not isinstance(class_path, str):
+            continue
+        class_path = class_path.strip()
+        key = class_path.removeprefix('./').removesuffix('.java')
+        if key and key not in seen:
+            seen.add(key)
+            cleaned.append(class_path)
+    return cleaned
+
+
+def diff_has_code_changes(diff_content: str) -> bool:
+    """Return True if the diff changes anything beyond blank lines and trailing whitespace.
+
+    The old and new side of each file's hunks, context lines included, are
+    compared after dropping blank lines and trailing whitespace, so moved or
+    reordered lines still count as changes. Empty diffs, binary-only diffs and
+    pure mode/rename changes have no hunks. Indentation and whitespace inside a
+    line are compared, since they can be significant (Python blocks, string
+    literals).
+    """
+    for section in _DIFF_FILE_START_RE.split(diff_content):
+        old_side = []
+        new_side = []
+        in_hunk = False
+        for line in section.splitlines():
+            if line.startswith('@@'):
+                in_hunk = True
+                continue
+            if not in_hunk or not line:
+                continue
+            sign, text = line[0], line[1:].rstrip()
+            if not text:
+                continue
+            if sign in ' -':
+                old_side.append(text)
+            if sign in ' +':
+                new_side.append(text)
+        if old_side != new_side:
+            return True
+    return False
+
+
+def split_diff_into_batches(diff_content: str, max_chars: int) -> List[str]:
+    """Split a git diff at file boundaries into batches of at most max_chars.
+
+    A single file's diff is never split, so it may exceed max_chars on its own.
+    """
+    batches = []
+    current = []
+    current_size = 0
+    for section in _DIFF_FILE_START_RE.split(diff_content):
+        if not section:
+            continue
+        if current and current_size + len(section) > max_chars:
+            batches.append(''.join(current))
+            current = []
+            current_size = 0
+        current.append(section)
+        current_size += len(section)
+    if current:
+        batches.append(''.join(current))
+    return batches
+
+
+def analyze_diff_for_dependencies(diff_content: str, cache_dir: Optional[str] = None) -> Tuple[List[str], bool]:
+    """Call Claude Code CLI to analyze git diff and suggest dependency classes for context.
+
+    Large diffs are split per file into batches that are analyzed in parallel
+    and the class lists merged. If cache_dir is given, a previous answer for
+    an identical diff (or batch) is reused.
+    Returns the classes and whether the analysis completed; it is incomplete
+    when the Claude request (or any batch request) failed.
+    """
+    if not diff_has_code_changes(diff_content):
+        print("✓ Diff has no code changes, skipping dependency analysis")
+        return [], True
+
+    if len(diff_content) <= DEPENDENCY_BATCH_CHARS:
+        classes = request_dependency_classes(diff_content, cache_dir)
+        return classes or [], classes is not None
+
+    batches = [
+        batch for batch in split_diff_into_batches(diff_content, DEPENDENCY_BATCH_CHARS)
+        if diff_has_code_changes(batch)
+    ]
+    print(f"Diff is large, analyzing it in {len(batches)} batches...")
+    with ThreadPoolExecutor(max_workers=DEPENDENCY_ANALYSIS_WORKERS) as executor:
+        results = list(executor.map(lambda batch: request_dependency_classes(batch, cache_dir), batches))
+
+    failed = [str(idx) for idx, batch_classes in enumerate(results, 1) if batch_classes is None]
+    classes = dedupe_class_paths([
+        class_path for batch_classes in results if batch_classes for class_path in batch_classes
+    ])
+    if failed:
+        print(f"⚠ Dependency analysis failed for batch(es) {', '.join(failed)} of {len(batches)}; "
+              f"found {len(classes)} dependency classes in the others")
+    else:
+        print(f"✓ Found {len(classes)} dependency classes across {len(batches)} batches")
+    return classes, not failed
+
+
+def request_dependency_classes(diff_content: str, cache_dir: Optional[str] = None) -> Optional[List[str]]:
+    """Ask Claude for the dependency classes of a single diff or diff batch.
+
+    Returns None if the request failed or its answer could not be parsed.
+    """
+    prompt = f"""## Git Diff Input
+{diff_content}
+"""
+
+    cache_file = None
+    if cache_dir:
+        cache_file = get_response_cache_file(
+            cache_dir, 'classes', DEPENDENCY_ANALYSIS_INSTRUCTIONS, [prompt.encode('utf-8')]
         )
+        classes = load_cached_response(cache_file)
+        if classes is not None:
+            print(f"✓ Reusing cached dependency analysis ({len(classes)} classes)")
+            return classes
+
+    print("Calling Claude Code CLI to analyze diff and suggest dependencies...")
 
-        response = json.loads(result.stdout)
+    try:
+        response = run_claude(prompt, DEPENDENCY_ANALYSIS_INSTRUCTIONS, DEPENDENCY_ANALYSIS_TIMEOUT)
 
         # Extract classes from response
         if "result" in response:
             result_text = response["result"]
             # Try to find JSON in the result
-            json_match = re.search(r'\{.*"classes".*\}', result_text, re.DOTALL)
-            if json_match:
-                classes_data = json.loads(json_match.group())
-                classes = classes_data.get("classes", [])
+            classes = parse_classes_from_response(result_text)
+            if classes is not None:
+                classes = dedupe_class_paths(classes)
                 print(f"✓ Found {len(classes)} dependency classes")
+                if cache_file:
+                    save_cached_response(cache_file, classes)
                 return classes
             else:
                 print("⚠ Could not parse classes from Claude response")
-                return []
+                return None
         else:
             print("⚠ Unexpected response format")
-            return []
+            return None
 
     except subprocess.TimeoutExpired:
         print("✗ Claude request timed out")
-        return []
+        return None
     except subprocess.CalledProcessError as e:
         print(f"✗ Error calling Claude CLI: {e.stderr}")
-        return []
+        return None
     except json.JSONDecodeError as e:
         print(f"✗ Error parsing Claude response: {e}")
-        return []
+        return None
     except FileNotFoundError:
         print("✗ 'claude' command not found. Please ensure Claude Code CLI is installed.")
-        return []
+        return None
     except Exception as e:
-        print(f"✗ Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+        logger.exception("✗ Unexpected error: %s", e)
+        return None
 
 
-def get_full_diff(repo_path: str, source_ref: str, dest_ref: str) -> str:
-    """Get the full diff between two branches."""
+def do_code_review(prompt_file: str, review_file: str, cache_dir: Optional[str] = None) -> Tuple[Optional[str], str]:
+    """Send the review prompt stored in prompt_file to Claude and save the review.
+
+    If cache_dir is given, a previous review of the identical prompt is reused.
+    Returns the review file path (None if the review failed) and the review text.
+    """
     try:
+        cache_file = None
+        review_text = None
+        if cache_dir:
+            cache_file = get_response_cache_file(
+                cache_dir, 'review', CODE_REVIEW_INSTRUCTIONS, iter_file_chunks(prompt_file)
+            )
+            review_text = load_cached_response(cache_file)
+
+        if review_text is not None:
+            print("✓ Reusing cached code review")
+            with open(review_file, 'w', encoding='utf-8') as f:
+                f.write(review_text)
+        else:
+            print("Sending prompt to LLM...")
+            # Write the review as it is generated to a .partial file next to
+            # the result (line buffering keeps it readable while Claude is
+            # still producing it); it only replaces the previous review once
+            # the request succeeded, and is removed if it failed
+            partial_file = f"{review_file}.partial"
+            streamed = []
+            try:
+                with open(partial_file, 'w', encoding='utf-8', buffering=1) as f:
+                    def write_text(text: str) -> None:
+                        f.write(text)
+                        streamed.append(text)
+
+                    claude_response = stream_claude(prompt_file, CODE_REVIEW_INSTRUCTIONS, CODE_REVIEW_TIMEOUT, write_text)
+
+                    # The result is the final assistant message; if Claude took
+                    # several turns, keep only that in the file
+                    review_text = claude_response.get("result")
+                    if review_text is None:
+                        review_text = ''.join(streamed)
+                    elif review_text != ''.join(streamed):
+                        f.seek(0)
+                        f.truncate()
+                        f.write(review_text)
+                os.replace(partial_file, review_file)
+            finally:
+                with suppress(FileNotFoundError):
+                    os.remove(partial_file)
+
+            print("✓ Claude review complete")
+
+            if cache_file and "result" in claude_response:
+                save_cached_response(cache_file, review_text)
+
+        return review_file, review_text
+    except subprocess.TimeoutExpired:
+        print("✗ Claude request timed out after 5 minutes")
+        return None, "[Timeout - no response received]"
+    except subprocess.CalledProcessError as e:
+        print(f"✗ Error calling Claude CLI: {e.stderr}")
+        return None, f"[Error: {e.stderr}]"
+    except json.JSONDecodeError as e:
+        print(f"✗ Error parsing Claude response: {e}")
+        return None, "[Error parsing response]"
+    except FileNotFoundError:
+        print("✗ 'claude' command not found. Please ensure Claude Code CLI is installed.")
+        return None, "[Claude CLI not found]"
+    except Exception as e:
+        logger.exception("✗ Unexpected error: %s", e)
+        return None, f"[Error: {str(e)}]"
+
+
+def write_full_diff(repo_path: str, source_ref: str, dest_ref: str, diff_file: str) -> None:
+    """Write the full diff between two branches to a file.
+
+    git's output is streamed straight into the file rather than being
+    buffered in memory and decoded first.
+    """
+    with open(diff_file, 'wb') as f:
         result = subprocess.run(
             ['git', 'diff', f'{source_ref}...{dest_ref}'],
             cwd=repo_path,
-            capture_output=True,
-            text=True,
-            check=True
+            env=_git_env(),
+            stdout=f,
+            stderr=subprocess.PIPE,
+            check=False
         )
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to get git diff: {e.stderr}")
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to get git diff: {result.stderr.decode('utf-8', 'replace')}")
+
+
+def get_context_cache_key(repo_path: str, source_ref: str, dest_ref: str, fast_path: bool = True) -> Optional[str]:
+    """Build the dependency-context cache key from the commits both refs point to.
+
+    The packing mode is part of the key, so context packed with the fast path
+    is never served to a --no-fast-path run and vice versa.
+    """
+    source_sha = resolve_commit_sha(repo_path, source_ref)
+    dest_sha = resolve_commit_sha(repo_path, dest_ref)
+    if not source_sha or not dest_sha:
+        return None
+    pack_mode = 'fast-path' if fast_path else 'infiniloom'
+    return hashlib.sha1(f"{source_sha}:{dest_sha}:{pack_mode}".encode()).hexdigest()
+
+
+def load_cached_context(cache_dir: str, cache_key: str, output_file: str) -> Optional[List[str]]:
+    """Restore a cached llm.txt to output_file and return its classes, or None on a miss."""
+    classes_file = os.path.join(cache_dir, f'{cache_key}.classes.json')
+    llm_file = os.path.join(cache_dir, f'{cache_key}.llm.txt')
+    if not (os.path.isfile(classes_file) and os.path.isfile(llm_file)):
+        return None
+
+    try:
+        with open(classes_file, 'r', encoding='utf-8') as f:
+            classes = json.load(f)
+        shutil.copyfile(llm_file, output_file)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"⚠ Ignoring unreadable cache entry {cache_key}: {e}")
+        return None
+
+    return classes
+
+
+def save_cached_context(cache_dir: str, cache_key: str, classes: List[str], output_file: str) -> None:
+    """Store the dependency classes and packed llm.txt for reuse on the same commits."""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        shutil.copyfile(output_file, os.path.join(cache_dir, f'{cache_key}.llm.txt'))
+        with open(os.path.join(cache_dir, f'{cache_key}.classes.json'), 'w', encoding='utf-8') as f:
+            json.dump(classes, f)
+    except OSError as e:
+        print(f"⚠ Could not cache dependency context: {e}")
+
+
+def try_diff(repo_path: str, source: str, dest: str, diff_file: str) -> bool:
+    """Write the diff between two refs as given, returning False if git cannot resolve them."""
+    try:
+        write_full_diff(repo_path, source, dest, diff_file)
+        return True
+    except RuntimeError:
+        return False
+
 
 def main():
     """Main execution function."""
@@ -325,9 +1181,17 @@ def main():
     parser.add_argument('destination_branch', help='Destination branch name')
     parser.add_argument('--repo-path', help='Path to repository (overrides REPO_PATH env var)', default=None)
     parser.add_argument('--output-dir', help='Output directory', default='output')
+    parser.add_argument('--no-fast-path', action='store_true',
+                        help=f'Always pack dependencies with infiniloom, even for {FAST_PATH_THRESHOLD} or fewer classes')
+    parser.add_argument('--fetch-all', action='store_true',
+                        help='Run "git fetch --all" before comparing (by default only missing branches are fetched)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Ignore and do not update cached dependency context and Claude responses from previous runs')
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
     try:
         # Get repository path
         if args.repo_path:
@@ -335,168 +1199,159 @@ def main():
         else:
             repo_path = get_repo_path()
 
-        # Get script directory for output
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        output_dir = os.path.join(script_dir, args.output_dir)
-        os.makedirs(output_dir, exist_ok=True)
+        output_path = Path(SCRIPT_DIR, args.output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+        diff_file = str(output_path / 'diff.txt')
+        llm_file = str(output_path / 'llm.txt')
+        prompt_file = str(output_path / 'prompt.txt')
+        review_output_file = str(output_path / 'code_review_result.md')
+        cache_dir = str(output_path / '.cache')
 
         print(f"Repository path: {repo_path}")
         print(f"Analyzing changes: {args.source_branch} -> {args.destination_branch}")
 
-        # Ensure branches exist
-        print("Verifying branches...")
-        source_ref = ensure_branch_exists(repo_path, args.source_branch)
-        dest_ref = ensure_branch_exists(repo_path, args.destination_branch)
+        # Step 1: Get full diff and save to file. Both names usually resolve
+        # as-is, so only probe and fetch branches when the direct diff fails.
+        if args.fetch_all:
+            fetch_all_branches(repo_path)
 
-        # Step 1: Get full diff and save to file
         print("Getting git diff...")
-        full_diff = get_full_diff(repo_path, source_ref, dest_ref)
-
-        # Save diff to file for debugging
-        diff_file = os.path.join(output_dir, 'diff.txt')
-        with open(diff_file, 'w', encoding='utf-8') as f:
-            f.write(full_diff)
-
-        # Step 2: Analyze diff with Claude to get dependency classes
-        print("Analyzing diff to identify dependency classes..")
-        classes = analyze_diff_for_dependencies(full_diff)
+        source_ref, dest_ref = args.source_branch, args.destination_branch
+
+        if not try_diff(repo_path, source_ref, dest_ref, diff_file):
+            # Ensure branches exist
+            print("Verifying branches...")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(ensure_branch_exists, repo_path, args.source_branch)
+                dest_future = executor.submit(ensure_branch_exists, repo_path, args.destination_branch)
+                source_ref = source_future.result()
+                dest_ref = dest_future.result()
+
+            write_full_diff(repo_path, source_ref, dest_ref, diff_file)
+
+        # The diff is embedded in both Claude prompts, so it has to be
+        # loaded once; undecodable bytes must not abort the review
+        with open(diff_file, 'r', encoding='utf-8', errors='replace') as f:
+            full_diff = f.read()
+
+        # The dependency context only depends on the two commits and the
+        # packing mode, so reuse the one packed by a previous run on the same pair
+        cache_key = None if args.no_cache else get_context_cache_key(
+            repo_path, source_ref, dest_ref, fast_path=not args.no_fast_path
+        )
+        cached_classes = load_cached_context(cache_dir, cache_key, llm_file) if cache_key else None
+
+        # Cached Claude responses are only reused within RESPONSE_CACHE_TTL;
+        # drop older ones so the cache does not grow without bound
+        if not args.no_cache:
+            prune_response_cache(cache_dir)
+
+        tree_files_future = None
+        if cached_classes is not None:
+            print("✓ Reusing cached dependency context for these commits")
+            classes = cached_classes
+            classes_complete = True
+        else:
+            # Step 2: Analyze diff with Claude to get dependency classes. The
+            # destination file listing used to locate those classes does not
+            # depend on the result, so it is read while Claude is working.
+            print("Analyzing diff to identify dependency classes..")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                tree_files_future = executor.submit(list_tree_files, repo_path, dest_ref)
+                classes_future = executor.submit(
+                    analyze_diff_for_dependencies, full_diff, None if args.no_cache else cache_dir
+                )
+                classes, classes_complete = classes_future.result()
 
         if classes:
             print(f"\nDependency classes identified:")
-            for idx, cls in enumerate(classes, 1):
-                print(f"  {idx}. {cls}")
+            sys.stdout.write(''.join(f"  {idx}. {cls}\n" for idx, cls in enumerate(classes, 1)))
         else:
             print("⚠ No dependency classes identified")
         print()
 
 
-        # Step 3: Checkout destination branch and pack dependencies with infiniloom
+        # Step 3: Pack dependencies from the destination branch with infiniloom
         print("Packing dependency classes with infiniloom...")
         llm_content = ""
         output_file = None
+        packed = False
 
         if classes:
             try:
-                current_branch = get_current_branch(repo_path)
-                # Checkout destination branch if not already on it
-                if current_branch != dest_ref and current_branch != args.destination_branch:
-                    checkout_branch(repo_path, dest_ref)
+                if cached_classes is not None:
+                    output_file = llm_file
                 else:
-                    print("✓ Already on destination branch")
-
-                # Execute infiniloom pack with the class list
-                output_file = execute_infiniloom_pack_with_classes(repo_path, classes, output_dir)
+                    # Classes that map to known files are read from git
+                    # directly, so the working tree is left alone: a handful
+                    # are written as-is, more are packed by infiniloom
+                    class_files = resolve_class_files(tree_files_future.result(), classes)
+
+                    if class_files and not args.no_fast_path and len(class_files) <= FAST_PATH_THRESHOLD:
+                        output_file = pack_files_from_git(repo_path, dest_ref, class_files, llm_file)
+                    elif class_files:
+                        output_file = execute_infiniloom_pack_from_git(repo_path, dest_ref, class_files, llm_file)
+                    else:
+                        # Pack from a throwaway worktree of the destination branch
+                        with destination_worktree(repo_path, dest_ref) as worktree_dir:
+                            output_file = execute_infiniloom_pack_with_classes(worktree_dir, classes, llm_file)
+
+                    # A partial class list must not be served to later runs
+                    if cache_key and classes_complete:
+                        save_cached_context(cache_dir, cache_key, classes, output_file)
+                    elif cache_key:
+                        print("⚠ Dependency analysis was incomplete, not caching the dependency context")
 
                 # Read llm.txt content
-                if output_file and os.path.exists(output_file):
+                packed = output_file is not None and os.path.isfile(output_file)
+                if packed:
                     with open(output_file, 'r', encoding='utf-8') as f:
                         llm_content = f.read()
                     print(f"✓ LLM content read ({len(llm_content)} characters)\n")
             except Exception as e:
-                print(f"\n✗ Error packing dependencies: {str(e)}")
-                import traceback
-                traceback.print_exc()
+                logger.exception("\n✗ Error packing dependencies: %s", e)
                 llm_content = "[Dependency context not available - infiniloom pack failed]"
                 print()
 
-        # Step 4: Create final prompt and get code review from Claude
-        final_prompt = f"""Given the Git Diff and Reference as additional context, please help review Git Diff and provide suggestions if needed.
-----
-## Git Diff:
-Changes between {args.source_branch} and {args.destination_branch}:
-```diff
-{full_diff}
-```
-----
-## Reference as Additional Context (Related Classes)
-{llm_content}
----
-Please provide a comprehensive code review focusing on:
-- Code quality and best practices
-- Potential bugs or issues
-- Performance considerations
-- Security concerns
-- Potential Business logic impact
-- Suggestions for improvements
-"""
-
-        # Save prompt for debugging
-        prompt_file = os.path.join(output_dir, 'prompt.txt')
+        # Step 4: Create final prompt and get code review from Claude. The
+        # prompt is written piece by piece so the diff and context are never
+        # concatenated into one more in-memory copy; Claude reads the file.
         with open(prompt_file, 'w', encoding='utf-8') as f:
-            f.write(final_prompt)
+            f.write(f"## Git Diff:\nChanges between {args.source_branch} and {args.destination_branch}:\n```diff\n")
+            f.write(full_diff)
+            f.write("\n```\n----\n## Reference as Additional Context (Related Classes)\n")
+            f.write(llm_content)
+            f.write("\n")
         print(f"✓ Prompt saved to: {prompt_file}")
 
         # Send to Claude for review
-        review_file = None
-        review_text = ""
-
-        try:
-            print("Sending prompt to LLM...")
-            result = subprocess.run(
-                ["claude", "-p", final_prompt, "--output-format", "json"],
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=300000  # 5 minute timeout
-            )
-
-            print("✓ Claude review complete")
-
-            # Parse the response
-            claude_response = json.loads(result.stdout)
-
-            # Extract the review from the response
-            if "result" in claude_response:
-                review_text = claude_response["result"]
-            else:
-                review_text = json.dumps(claude_response, indent=2)
+        review_file, review_text = do_code_review(
+            prompt_file, review_output_file,
+            None if args.no_cache else cache_dir
+        )
 
-            # Save review to file
-            review_file = os.path.join(output_dir, 'code_review_result.md')
-            with open(review_file, 'w', encoding='utf-8') as f:
-                f.write(review_text)
-        except subprocess.TimeoutExpired:
-            print("✗ Claude request timed out after 5 minutes")
-            review_text = "[Timeout - no response received]"
-        except subprocess.CalledProcessError as e:
-            print(f"✗ Error calling Claude CLI: {e.stderr}")
-            review_text = f"[Error: {e.stderr}]"
-        except json.JSONDecodeError as e:
-            print(f"✗ Error parsing Claude response: {e}")
-            review_text = "[Error parsing response]"
-        except FileNotFoundError:
-            print("✗ 'claude' command not found. Please ensure Claude Code CLI is installed.")
-            review_text = "[Claude CLI not found]"
-        except Exception as e:
-            print(f"✗ Unexpected error: {e}")
-            import traceback
-            traceback.print_exc()
-            review_text = f"[Error: {str(e)}]"
-
-        # Final summary
-        print("\n" + "="*20)
-        print("SUMMARY")
-        print("="*20)
-        print(f"✓ Diff file: {diff_file}")
-        print(f"✓ Dependencies identified: {len(classes)}")
-        if output_file and os.path.exists(output_file):
-            print(f"✓ Dependencies packed: {output_file}")
-        print(f"✓ Prompt file: {prompt_file}")
+        # Final summary, written in one go
+        summary = ["\n" + "="*20, "SUMMARY", "="*20,
+                   f"✓ Diff file: {diff_file}",
+                   f"✓ Dependencies identified: {len(classes)}"]
+        if packed:
+            summary.append(f"✓ Dependencies packed: {output_file}")
+        summary.append(f"✓ Prompt file: {prompt_file}")
         if review_file:
-            print(f"✓ Code review: {review_file}")
+            summary.append(f"✓ Code review: {review_file}")
         else:
-            print(f"✗ Code review: Failed")
-        print("="*20)
-
-        # Return data structure
-        return {
-            'diff_file': diff_file,
-            'classes': classes,
-            'output_file': output_file,
-            'prompt_file': prompt_file,
-            'review_file': review_file,
-            'review': review_text
-        }
+            summary.append("✗ Code review: Failed")
+        summary.append("="*20)
+        sys.stdout.write('\n'.join(summary) + '\n')
+
+        return ReviewResult(
+            diff_file=diff_file,
+            classes=classes,
+            output_file=output_file,
+            prompt_file=prompt_file,
+            review_file=review_file,
+            review=review_text
+        )
 
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
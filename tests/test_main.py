@@ -0,0 +1,91 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import main
+
+
+def file_diff(name: str, hunk: str) -> str:
+    return f"diff --git a/{name} b/{name}\n--- a/{name}\n+++ b/{name}\n{hunk}"
+
+
+REORDER_DIFF = file_diff('A.java', "@@ -1,2 +1,2 @@\n-validate(x);\n save(x);\n+validate(x);\n")
+WHITESPACE_DIFF = file_diff('B.java', "@@ -1,2 +1,3 @@\n x();\n-y();  \n+y();\n+\n")
+
+
+class DiffHasCodeChangesTest(unittest.TestCase):
+
+    def test_reordered_lines_are_a_change(self):
+        self.assertTrue(main.diff_has_code_changes(REORDER_DIFF))
+
+    def test_line_moved_between_files_is_a_change(self):
+        diff = (file_diff('A.java', "@@ -1,2 +1 @@\n bar();\n-foo();\n")
+                + file_diff('B.java', "@@ -1 +1,2 @@\n baz();\n+foo();\n"))
+        self.assertTrue(main.diff_has_code_changes(diff))
+
+    def test_trailing_whitespace_and_blank_lines_are_not_a_change(self):
+        self.assertFalse(main.diff_has_code_changes(WHITESPACE_DIFF))
+
+
+class AnalyzeDiffBatchingTest(unittest.TestCase):
+
+    def test_batch_with_only_a_reorder_is_analyzed(self):
+        diff = REORDER_DIFF + WHITESPACE_DIFF
+        with mock.patch.object(main, 'DEPENDENCY_BATCH_CHARS', len(REORDER_DIFF)), \
+                mock.patch.object(main, 'request_dependency_classes', return_value=['com/ex/A']) as request:
+            classes, complete = main.analyze_diff_for_dependencies(diff)
+
+        request.assert_called_once_with(REORDER_DIFF, None)
+        self.assertEqual(classes, ['com/ex/A'])
+        self.assertTrue(complete)
+
+
+
+class ResolveClassFilesTest(unittest.TestCase):
+
+    TREE = ['src/main/java/com/ex/Foo.java', 'src/main/java/com/ex/Bar.java']
+
+    def test_spellings_of_the_same_class_resolve_once(self):
+        self.assertEqual(main.resolve_class_files(self.TREE, ['com/ex/Foo', 'Bar', 'Foo']),
+                         ['src/main/java/com/ex/Foo.java', 'src/main/java/com/ex/Bar.java'])
+
+
+    def test_java_source_wins_over_same_named_resources(self):
+        tree = ['src/main/java/com/ex/FooMapper.java', 'src/main/resources/com/ex/FooMapper.xml']
+        self.assertEqual(main.resolve_class_files(tree, ['com/ex/FooMapper']),
+                         ['src/main/java/com/ex/FooMapper.java'])
+        self.assertEqual(main.resolve_class_files(tree, ['com/ex/FooMapper.xml']),
+                         ['src/main/resources/com/ex/FooMapper.xml'])
+
+    def test_ambiguous_class_is_not_resolved(self):
+        tree = ['a/com/ex/Foo.java', 'b/com/ex/Foo.java']
+        self.assertIsNone(main.resolve_class_files(tree, ['com/ex/Foo']))
+
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_prune_deletes_only_expired_responses(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            expired = main.get_response_cache_file(cache_dir, 'review', 'system', [b'old'])
+            fresh = main.get_response_cache_file(cache_dir, 'review', 'system', [b'new'])
+            main.save_cached_response(expired, 'old review')
+            main.save_cached_response(fresh, 'new review')
+            context = os.path.join(cache_dir, 'key.classes.json')
+            with open(context, 'w', encoding='utf-8') as f:
+                f.write('[]')
+            past = time.time() - main.RESPONSE_CACHE_TTL - 60
+            os.utime(expired, (past, past))
+            os.utime(context, (past, past))
+
+            main.prune_response_cache(cache_dir)
+
+            self.assertFalse(os.path.exists(expired))
+            self.assertEqual(main.load_cached_response(fresh), 'new review')
+            self.assertTrue(os.path.exists(context))
+
+
+if __name__ == '__main__':
+    unittest.main()